@@ -1,31 +1,43 @@
 import asyncio
-import yfinance as yf
-import pandas as pd
-import pandas_ta as ta
+import aiohttp
+import csv
+from aiohttp import web
+import numpy as np
+import orjson
 import os
-import requests
-import json
-from datetime import datetime
-from textblob import TextBlob
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+import tempfile
+import time
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
+from telegram import InputFile, Update
+from telegram.ext import AIORateLimiter, Application, CommandHandler, ContextTypes
 
 # --- Keep-Alive Server for Replit ---
-from flask import Flask
-from threading import Thread
-
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "Kiyofm Bot is alive!"
-
-def run_web_server():
-  app.run(host='0.0.0.0', port=8080)
+_web_runner = None # aiohttp runner for the keep-alive server, set by keep_alive()
+
+async def home(request):
+    return web.Response(text="Kiyofm Bot is alive!")
+
+async def keep_alive(application):
+    """Serves the keep-alive page on the bot's own event loop."""
+    global _web_runner
+    app = web.Application()
+    app.router.add_get('/', home)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host='0.0.0.0', port=8080).start()
+    except OSError as e:
+        # Losing the health page shouldn't stop the bot itself
+        print(f"WARNING: Keep-alive server could not start: {e}")
+        await runner.cleanup()
+        return
+    _web_runner = runner
 
-def keep_alive():
-    t = Thread(target=run_web_server)
-    t.start()
+async def stop_keep_alive():
+    """Stops the keep-alive server started by keep_alive()."""
+    if _web_runner is not None:
+        await _web_runner.cleanup()
 
 # --- CONFIGURATION (from Replit Secrets) ---
 # Securely load credentials from environment variables (Replit Secrets)
@@ -43,29 +55,118 @@ if not all([TELEGRAM_TOKEN, CHAT_ID, NEWS_API_KEY]):
 TICKER = "RELIANCE.NS"
 TRADE_LOG_FILE = "completed_trades.csv"
 STATE_FILE = "trade_state.json" # File to store the current open position
+STATS_FILE = "trade_stats.json" # Running summary of TRADE_LOG_FILE used by /report
+TRADE_LOG_COLUMNS = [
+    "Entry Time", "Exit Time", "Ticker", "Trade Type",
+    "Entry Price", "Exit Price", "Profit/Loss", "P/L %", "P/L Value",
+]
+NEWS_API_TIMEOUT = 5 # Hard deadline (seconds) for a NewsAPI request
+NEWS_CACHE_TTL = 1500 # Reuse sentiment for one extra 15-minute check, so news is refetched every other check
+SENTIMENT_THRESHOLD = 0.5 # Summed VADER compound score needed for Positive/Negative
+NEWS_HEADLINE_COUNT = 5 # Number of latest headlines fetched and scored
+IST = ZoneInfo("Asia/Kolkata")
+MARKET_OPEN = dt_time(9, 15, tzinfo=IST)
+MARKET_CLOSE = dt_time(15, 30, tzinfo=IST)
+MARKET_DAYS = (1, 2, 3, 4, 5) # Monday to Friday in JobQueue.run_daily numbering (0 = Sunday)
+CHECK_INTERVAL_MINUTES = 15
 
 # --- STATE & LOGGING FUNCTIONS ---
 
+_state_cache = None # In-memory copy of STATE_FILE, loaded on first use
+
 def get_trade_state():
-    """Reads the current trade state from a JSON file."""
+    """Returns the current trade state, reading the JSON file only on first use."""
+    global _state_cache
+    if _state_cache is None:
+        try:
+            with open(STATE_FILE, "rb") as f:
+                _state_cache = orjson.loads(f.read())
+        except FileNotFoundError:
+            _state_cache = {"open_position": None, "entry_price": 0}
+    return dict(_state_cache)
+
+def write_json_atomic(path, data):
+    """Writes data as JSON to a temporary file and atomically moves it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
     try:
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {"open_position": None, "entry_price": 0}
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 def set_trade_state(state):
-    """Writes the current trade state to a JSON file."""
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f)
+    """Updates the trade state and atomically writes it to the JSON file if it changed."""
+    global _state_cache
+    if state == _state_cache:
+        return
+    write_json_atomic(STATE_FILE, state)
+    _state_cache = dict(state)
+
+def empty_trade_stats():
+    """Returns the trade summary for a log with no trades."""
+    return {"total": 0, "wins": 0, "losses": 0, "total_pnl": 0.0}
+
+def trade_log_size():
+    """Returns the size of the trade log in bytes, or 0 if it doesn't exist."""
+    try:
+        return os.path.getsize(TRADE_LOG_FILE)
+    except FileNotFoundError:
+        return 0
+
+def compute_trade_stats():
+    """Recomputes the trade summary by reading the P/L column of the full trade log."""
+    if trade_log_size() == 0:
+        return empty_trade_stats()
+    import pandas as pd # Imported lazily to keep bot start-up fast
+    trades_df = pd.read_csv(TRADE_LOG_FILE, usecols=lambda column: column in ("Profit/Loss", "P/L Value"))
+    if "P/L Value" in trades_df.columns:
+        pnl = trades_df["P/L Value"]
+    else: # Logs written before the numeric column existed
+        pnl = trades_df["Profit/Loss"].replace({r'[₹]': ''}, regex=True).astype(float)
+    return {
+        "total": len(pnl),
+        "wins": int((pnl > 0).sum()),
+        "losses": int((pnl <= 0).sum()),
+        "total_pnl": round(float(pnl.sum()), 2),
+    }
+
+def get_trade_stats():
+    """Returns the trade summary from STATS_FILE, rebuilding it if it no longer matches the trade log.
+
+    The summary records the log's size when it was written, so a log that was
+    deleted, emptied or edited since then triggers a rebuild.
+    """
+    log_size = trade_log_size()
+    try:
+        with open(STATS_FILE, "rb") as f:
+            stats = orjson.loads(f.read())
+        if stats.get("log_size") == log_size:
+            return stats
+    except FileNotFoundError:
+        pass
+    stats = compute_trade_stats()
+    stats["log_size"] = log_size
+    write_json_atomic(STATS_FILE, stats)
+    return stats
+
+def add_to_trade_stats(stats, profit_loss):
+    """Adds one completed trade, with P/L rounded as in the trade log, to the summary in STATS_FILE."""
+    stats["total"] += 1
+    stats["wins" if profit_loss > 0 else "losses"] += 1
+    stats["total_pnl"] = round(stats["total_pnl"] + profit_loss, 2)
+    stats["log_size"] = trade_log_size()
+    write_json_atomic(STATS_FILE, stats)
 
 def log_completed_trade(entry_time, exit_time, trade_type, entry_price, exit_price):
     """Logs a completed trade to the CSV file and calculates P&L."""
-    profit_loss = exit_price - entry_price
+    profit_loss = round(exit_price - entry_price, 2)
     profit_loss_percent = (profit_loss / entry_price) * 100
     
-    header_needed = not os.path.exists(TRADE_LOG_FILE)
-    log_entry = pd.DataFrame([{
+    # Load (or rebuild) the summary before appending, so a rebuild doesn't count this trade twice
+    stats = get_trade_stats()
+    log_entry = {
         "Entry Time": entry_time,
         "Exit Time": exit_time,
         "Ticker": TICKER,
@@ -73,67 +174,138 @@ def log_completed_trade(entry_time, exit_time, trade_type, entry_price, exit_pri
         "Entry Price": f"₹{entry_price:.2f}",
         "Exit Price": f"₹{exit_price:.2f}",
         "Profit/Loss": f"₹{profit_loss:.2f}",
-        "P/L %": f"{profit_loss_percent:.2f}%"
-    }])
-    log_entry.to_csv(TRADE_LOG_FILE, mode='a', header=header_needed, index=False)
+        "P/L %": f"{profit_loss_percent:.2f}%",
+        "P/L Value": f"{profit_loss:.2f}"
+    }
+    header_needed = trade_log_size() == 0
+    if header_needed:
+        columns = TRADE_LOG_COLUMNS
+    else: # Keep an existing log's column layout so older files stay readable
+        with open(TRADE_LOG_FILE, "r", newline="", encoding="utf-8") as f:
+            columns = next(csv.reader(f), TRADE_LOG_COLUMNS)
+    with open(TRADE_LOG_FILE, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n") # Match the line endings of logs written by pandas
+        if header_needed:
+            writer.writerow(columns)
+        writer.writerow([log_entry.get(column, "") for column in columns])
+    add_to_trade_stats(stats, profit_loss) # Only once the trade is in the log
     return profit_loss, profit_loss_percent
 
 # --- TRADING & NEWS LOGIC ---
 
+def get_closes(period, interval):
+    """Downloads TICKER's price history and returns just the closing prices as an array."""
+    import yfinance as yf # Imported lazily to keep bot start-up fast
+    data = yf.Ticker(TICKER).history(period=period, interval=interval)
+    return data["Close"].to_numpy(dtype=float) # Drop the DataFrame, keep only what the signal needs
+
+def sma_last_two(closes, length):
+    """Returns the simple moving average at the previous and the last bar."""
+    if len(closes) < length + 1:
+        return np.nan, np.nan
+    return closes[-length - 1:-1].mean(), closes[-length:].mean()
+
+def rsi_last(closes, length):
+    """Returns the RSI at the last bar using Wilder's smoothing (same as pandas_ta)."""
+    diffs = np.diff(closes)
+    if len(diffs) < length:
+        return np.nan
+    weights = (1.0 - 1.0 / length) ** np.arange(len(diffs))[::-1]
+    avg_gain = np.dot(weights, np.clip(diffs, 0, None)) / weights.sum()
+    avg_loss = np.dot(weights, np.clip(-diffs, 0, None)) / weights.sum()
+    return 100 * avg_gain / (avg_gain + avg_loss)
+
+def compute_signal(closes):
+    """Returns 1 for a buy, -1 for a sell or 0 for no signal from an array of closes."""
+    sma_prev, sma_last = sma_last_two(closes, 5)
+    rsi = rsi_last(closes, 14)
+    if closes[-2] < sma_prev and closes[-1] > sma_last and rsi < 70:
+        return 1
+    if closes[-2] > sma_prev and closes[-1] < sma_last and rsi > 30:
+        return -1
+    return 0
+
+SIGNAL_NAMES = {1: "BUY", -1: "SELL", 0: None}
+
 def get_signal_and_price():
     """Fetches stock data and determines a buy/sell signal and the current price."""
-    ticker_obj = yf.Ticker(TICKER)
-    data = ticker_obj.history(period="2d", interval="15m")
-    if data.empty: return None, None
-    data.ta.sma(length=5, append=True)
-    data.ta.rsi(length=14, append=True)
-    data.rename(columns={"SMA_5": "SMA", "RSI_14": "RSI"}, inplace=True)
-    if len(data) < 2: return None, None
-    last_row = data.iloc[-1]
-    previous_row = data.iloc[-2]
-    signal = None
-    if previous_row["Close"] < previous_row["SMA"] and last_row["Close"] > last_row["SMA"] and last_row["RSI"] < 70:
-        signal = "BUY"
-    elif previous_row["Close"] > previous_row["SMA"] and last_row["Close"] < last_row["SMA"] and last_row["RSI"] > 30:
-        signal = "SELL"
-    return signal, last_row['Close']
-
-def get_news_sentiment(stock_ticker):
-    """Fetches news and analyzes sentiment."""
+    closes = get_closes(period="2d", interval="15m")
+    if len(closes) < 2: return None, None
+    return SIGNAL_NAMES[compute_signal(closes)], float(closes[-1])
+
+_news_session = None # aiohttp session for NewsAPI only (carries the API key), created on first use inside the event loop
+
+def get_news_session():
+    """Returns the NewsAPI session, which sends the API key and keeps connections alive between calls."""
+    global _news_session
+    if _news_session is None or _news_session.closed:
+        _news_session = aiohttp.ClientSession(
+            headers={"X-Api-Key": NEWS_API_KEY}, # Keeps the key out of request URLs and logs
+            timeout=aiohttp.ClientTimeout(total=NEWS_API_TIMEOUT),
+        )
+    return _news_session
+
+async def close_news_session():
+    """Closes the NewsAPI session."""
+    if _news_session is not None and not _news_session.closed:
+        await _news_session.close()
+
+async def fetch_news_articles(query):
+    """Fetches the latest news articles for a query from NewsAPI."""
+    url = "https://newsapi.org/v2/everything"
+    params = {"q": query, "language": "en", "sortBy": "publishedAt", "pageSize": NEWS_HEADLINE_COUNT}
+    async with get_news_session().get(url, params=params) as response:
+        response.raise_for_status()
+        return (await response.json(loads=orjson.loads)).get("articles", [])
+
+_sentiment_cache = {} # ticker -> (fetched_at, sentiment)
+_sentiment_analyzer = None # VADER analyzer, created on first use
+
+def get_sentiment_analyzer():
+    """Returns the shared VADER analyzer, loading its lexicon on first use."""
+    global _sentiment_analyzer
+    if _sentiment_analyzer is None:
+        from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+        _sentiment_analyzer = SentimentIntensityAnalyzer()
+    return _sentiment_analyzer
+
+async def get_news_sentiment(stock_ticker):
+    """Fetches news and analyzes sentiment, reusing a result younger than NEWS_CACHE_TTL."""
+    cached = _sentiment_cache.get(stock_ticker)
+    if cached is not None and time.monotonic() - cached[0] < NEWS_CACHE_TTL:
+        return cached[1]
     try:
         query = stock_ticker.replace(".NS", "")
-        url = f"https://newsapi.org/v2/everything?q={query}&apiKey={NEWS_API_KEY}&language=en&sortBy=publishedAt&pageSize=10"
-        response = requests.get(url)
-        response.raise_for_status()
-        articles = response.json().get("articles", [])
-        if not articles: return "Neutral"
-        sentiment_polarity = sum(TextBlob(article['title']).sentiment.polarity for article in articles[:5])
-        if sentiment_polarity > 0.3: return "Positive"
-        if sentiment_polarity < -0.3: return "Negative"
-        return "Neutral"
+        articles = await asyncio.wait_for(fetch_news_articles(query), timeout=NEWS_API_TIMEOUT)
     except Exception:
-        return "Neutral"
+        return "Neutral" # Not cached, so the next check retries the request
+    sentiment = "Neutral"
+    if articles:
+        analyzer = get_sentiment_analyzer()
+        sentiment_polarity = sum(
+            analyzer.polarity_scores(article.get('title') or "")['compound'] for article in articles[:NEWS_HEADLINE_COUNT]
+        )
+        if sentiment_polarity > SENTIMENT_THRESHOLD: sentiment = "Positive"
+        elif sentiment_polarity < -SENTIMENT_THRESHOLD: sentiment = "Negative"
+    _sentiment_cache[stock_ticker] = (time.monotonic(), sentiment)
+    return sentiment
 
 # --- CORE BOT JOB ---
 
 async def check_trades(context: ContextTypes.DEFAULT_TYPE):
     """The main function that runs periodically to check for trade signals."""
-    now_ist = datetime.now()
-    market_open = now_ist.replace(hour=9, minute=15, second=0, microsecond=0)
-    market_close = now_ist.replace(hour=15, minute=30, second=0, microsecond=0)
-    
-    # Only run during market hours on weekdays
-    if not (market_open <= now_ist <= market_close and 0 <= now_ist.weekday() <= 4):
-        return
-
+    now_ist = datetime.now(IST)
     print(f"\nRunning trade check at {now_ist.strftime('%H:%M:%S')}...")
-    signal, price = get_signal_and_price()
+    # Price history (blocking yfinance call, run in a thread) and news are fetched concurrently
+    (signal, price), sentiment = await asyncio.gather(
+        asyncio.to_thread(get_signal_and_price),
+        get_news_sentiment(TICKER),
+    )
     if not signal:
         print("No technical signal found.")
         return
 
     state = get_trade_state()
-    sentiment = get_news_sentiment(TICKER)
 
     # --- ENTRY LOGIC ---
     if signal == "BUY" and state["open_position"] is None and sentiment != "Negative":
@@ -177,24 +349,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /report command. Sends a trade summary."""
     try:
-        trades_df = pd.read_csv(TRADE_LOG_FILE)
-        if trades_df.empty:
+        if not os.path.exists(TRADE_LOG_FILE): # Don't report a summary of a log that is gone
+            raise FileNotFoundError(TRADE_LOG_FILE)
+        stats = get_trade_stats()
+        if stats["total"] == 0:
             await update.message.reply_text("No completed trades have been logged yet.")
             return
 
         # Calculate summary stats
-        total_trades = len(trades_df)
-        trades_df["P/L Value"] = trades_df["Profit/Loss"].replace({r'[₹]': ''}, regex=True).astype(float)
-        wins = trades_df[trades_df["P/L Value"] > 0]
-        losses = trades_df[trades_df["P/L Value"] <= 0]
-        win_rate = (len(wins) / total_trades) * 100 if total_trades > 0 else 0
-        total_pnl = trades_df["P/L Value"].sum()
+        total_trades = stats["total"]
+        win_rate = (stats["wins"] / total_trades) * 100
+        total_pnl = stats["total_pnl"]
 
         # Format the report message
         summary_message = (
             f"📊 *Kiyofm Trade Report*\n\n"
             f"*Total Trades:* {total_trades}\n"
-            f"*Wins:* {len(wins)} | *Losses:* {len(losses)}\n"
+            f"*Wins:* {stats['wins']} | *Losses:* {stats['losses']}\n"
             f"*Win Rate:* {win_rate:.2f}%\n"
             f"*Total P/L:* ₹{total_pnl:.2f}\n\n"
             f"Sending the full trade log as a file..."
@@ -202,7 +373,11 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(summary_message, parse_mode='Markdown')
         
         # Send the CSV file
-        await context.bot.send_document(chat_id=update.effective_chat.id, document=open(TRADE_LOG_FILE, 'rb'))
+        with open(TRADE_LOG_FILE, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=InputFile(f, filename=os.path.basename(TRADE_LOG_FILE))
+            )
 
     except FileNotFoundError:
         await update.message.reply_text("No trade report file found. Complete a trade to generate one.")
@@ -212,22 +387,41 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- MAIN BOT SETUP ---
 
+def market_check_times():
+    """Returns the times of day, from market open to close, at which trades are checked."""
+    start = MARKET_OPEN.hour * 60 + MARKET_OPEN.minute
+    end = MARKET_CLOSE.hour * 60 + MARKET_CLOSE.minute
+    return [
+        dt_time(minute // 60, minute % 60, tzinfo=IST)
+        for minute in range(start, end + 1, CHECK_INTERVAL_MINUTES)
+    ]
+
+async def shutdown(application):
+    """Releases network resources when the bot stops."""
+    await stop_keep_alive()
+    await close_news_session()
+
 def main():
     """Starts the bot, the web server, and the trading job."""
-    
-    # Start the keep-alive web server
-    keep_alive()
 
-    # Create the Telegram Bot Application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Create the Telegram Bot Application; the keep-alive web server starts with it
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(AIORateLimiter(max_retries=3)) # Throttle sends to Telegram's flood limits
+        .post_init(keep_alive)
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("report", report))
 
-    # Add the periodic job to check for trades
+    # Schedule the trade check every 15 minutes, only during market hours on weekdays
     job_queue = application.job_queue
-    job_queue.run_repeating(check_trades, interval=900, first=10) # 900 seconds = 15 minutes
+    for check_time in market_check_times():
+        job_queue.run_daily(check_trades, time=check_time, days=MARKET_DAYS)
 
     print("Bot started! Listening for commands and checking for trades...")
     